@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""Plans and applies syncs with sws against a moto server standing in for S3
+and CloudFront, and checks that planning doesn't change anything, that the
+estimates and the applied changes match the plan, and that stale or invalid
+plans are refused before anything is changed.
+
+Requires moto[server] to be installed (pip install 'moto[server]').
+"""
+
+import json
+import math
+import os
+import tempfile
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+from sharded_sync_moto import sws, write
+
+HOST_NAME = 'plan-apply-test'
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+def bucket_snapshot():
+    s3 = boto3.resource('s3')
+    if HOST_NAME not in [b.name for b in s3.buckets.all()]:
+        return None
+    return { o.key: o.e_tag for o in s3.Bucket(HOST_NAME).objects.all() }
+
+def invalidation_batches():
+    cf = boto3.client('cloudfront')
+    distributions = cf.list_distributions()['DistributionList'].get('Items', [])
+    if not distributions:
+        return []
+    distribution_id = distributions[0]['Id']
+    summaries = cf.list_invalidations(DistributionId=distribution_id)['InvalidationList'].get('Items', [])
+    return [cf.get_invalidation(DistributionId=distribution_id, Id=s['Id'])['Invalidation']['InvalidationBatch']['Paths'].get('Items', [])
+        for s in summaries]
+
+def local_files(site):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(site):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            files[os.path.relpath(path, site).replace(os.sep, '/')] = os.path.getsize(path)
+    return files
+
+def remote_files():
+    return { o.key: o.size for o in boto3.resource('s3').Bucket(HOST_NAME).objects.all() if o.key != '.staticwebsync' }
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def dump(plan, filename):
+    with open(filename, 'w') as f:
+        json.dump(plan, f)
+
+def assert_refused(expected_message, *args):
+    before = (bucket_snapshot(), invalidation_batches())
+    result = sws(*args, check=False)
+    assert result.returncode != 0 and expected_message in result.stdout, result.stdout
+    assert 'configuring' not in result.stdout and 'uploading' not in result.stdout, result.stdout
+    assert (bucket_snapshot(), invalidation_batches()) == before
+
+def main():
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+
+    os.environ['AWS_ENDPOINT_URL'] = 'http://%s:%d' % (host, port)
+    os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            site = os.path.join(tmp, 'site')
+            write(site, 'index.html', 'index')
+            write(site, 'a.html', 'a')
+            write(site, 'b.html', 'b')
+            write(site, 'sub/index.html', 'sub index')
+            write(site, 'big.bin', 'x' * (9 * 1024 * 1024))
+
+            # Planning the first sync of a site mustn't create anything:
+            first_plan = os.path.join(tmp, 'first.json')
+            sws('--plan', first_plan, HOST_NAME, site)
+            assert bucket_snapshot() is None
+            plan = load(first_plan)
+            assert plan['bucket'] is None
+            assert all(not u['existed'] and u['remote_e_tag'] is None for u in plan['uploads'])
+            assert plan['deletions'] == [] and plan['invalidation_paths'] == []
+
+            sizes = local_files(site)
+            upload_put_requests = 4 + (2 + math.ceil(sizes['big.bin'] / MULTIPART_CHUNK_SIZE))
+            estimates = plan['estimates']
+            assert estimates['upload_bytes'] == sum(sizes.values()), estimates
+            assert estimates['upload_put_requests'] == upload_put_requests, estimates
+            # Creating the bucket and its marker key, and configuring its ACL and web site:
+            assert estimates['put_requests'] == 4 + upload_put_requests, estimates
+            assert estimates['delete_requests'] == 0 and estimates['invalidation_paths'] == 0, estimates
+
+            sws('--apply', first_plan)
+            assert remote_files() == local_files(site)
+            assert invalidation_batches() == []
+
+            write(site, 'a.html', 'changed a')
+            write(site, 'new.html', 'new')
+            os.remove(os.path.join(site, 'sub', 'index.html'))
+
+            before = (bucket_snapshot(), invalidation_batches())
+            second_plan = os.path.join(tmp, 'second.json')
+            sws('--plan', second_plan, HOST_NAME, site)
+            assert (bucket_snapshot(), invalidation_batches()) == before
+
+            # The ETags of multipart uploads aren't MD5 hashes, so big.bin is
+            # always uploaded again:
+            plan = load(second_plan)
+            assert sorted(u['key'] for u in plan['uploads']) == ['a.html', 'big.bin', 'new.html']
+            assert [d['key'] for d in plan['deletions']] == ['sub/index.html']
+            assert sorted(plan['invalidation_paths']) == ['/a.html', '/big.bin', '/sub/index.html']
+            estimates = plan['estimates']
+            assert estimates['upload_put_requests'] == 2 + (2 + math.ceil(sizes['big.bin'] / MULTIPART_CHUNK_SIZE)), estimates
+            assert estimates['put_requests'] == 2 + estimates['upload_put_requests'], estimates
+            assert estimates['delete_requests'] == 1 and estimates['invalidation_batches'] == 1, estimates
+
+            damaged = os.path.join(tmp, 'damaged.json')
+            dump(dict(plan, uploads=[{ 'file': 1 }]), damaged)
+            assert_refused('is damaged', '--apply', damaged)
+
+            shard_results = os.path.join(tmp, 'shard.json')
+            dump({ 'format': 'staticwebsync shard results', 'version': 1 }, shard_results)
+            assert_refused("isn't a staticwebsync plan file", '--apply', shard_results)
+
+            assert_refused('--index is taken from the plan', '--apply', second_plan, '--index', 'x.html')
+
+            sws('--apply', second_plan)
+            assert remote_files() == local_files(site)
+            assert [sorted(paths) for paths in invalidation_batches()] == [sorted(plan['invalidation_paths'])]
+
+            # Applying the same plan again would undo any changes made since:
+            assert_refused('in the bucket has changed since the plan was made', '--apply', second_plan)
+
+            write(site, 'b.html', 'changed b')
+            third_plan = os.path.join(tmp, 'third.json')
+            sws('--plan', third_plan, HOST_NAME, site)
+            write(site, 'b.html', 'changed b again')
+            assert_refused('b.html has changed since the plan was made', '--apply', third_plan)
+    finally:
+        server.stop()
+
+    print('plan and apply OK')
+
+if __name__ == '__main__':
+    main()
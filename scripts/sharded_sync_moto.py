@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""Runs a sharded sync with several local sws processes against a moto server
+standing in for S3 and CloudFront, and checks that the bucket ends up matching
+the local folder.
+
+Requires moto[server] to be installed (pip install 'moto[server]').
+"""
+
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+HOST_NAME = 'sharded-sync-test'
+SHARD_COUNT = 4
+
+def sws(*args, check=True):
+    result = subprocess.run(
+        [sys.executable, '-m', 'staticwebsync.sws', '--dont-wait-for-cloudfront-propagation'] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if check and result.returncode != 0:
+        sys.exit('sws %s failed:\n%s' % (' '.join(args), result.stdout))
+    return result
+
+def write(folder, name, contents):
+    path = os.path.join(folder, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+def main():
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+
+    os.environ['AWS_ENDPOINT_URL'] = 'http://%s:%d' % (host, port)
+    os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            site = os.path.join(tmp, 'site')
+            for i in range(40):
+                write(site, 'page%d.html' % i, 'original %d' % i)
+            write(site, 'index.html', 'original index')
+            write(site, 'sub/index.html', 'original sub index')
+
+            # The bucket has to be created by an ordinary sync:
+            sws(HOST_NAME, site)
+
+            for i in range(0, 40, 3):
+                write(site, 'page%d.html' % i, 'changed %d' % i)
+            write(site, 'sub/index.html', 'changed sub index')
+            write(site, 'new.html', 'new')
+            os.remove(os.path.join(site, 'page1.html'))
+
+            run_id = 'run-1'
+            results = [os.path.join(tmp, 'shard%d.json' % i) for i in range(1, SHARD_COUNT + 1)]
+            shards = [subprocess.Popen(
+                [sys.executable, '-m', 'staticwebsync.sws', '--shard', '%d/%d' % (i, SHARD_COUNT),
+                    '--shard-results', results[i - 1], '--shard-run-id', run_id, HOST_NAME, site],
+                stdout=subprocess.DEVNULL) for i in range(1, SHARD_COUNT + 1)]
+            for p in shards:
+                assert p.wait() == 0
+
+            stale = sws('--merge-shard-results', *results, '--shard-run-id', 'run-2', HOST_NAME, site, check=False)
+            assert stale.returncode != 0 and 'is from the run' in stale.stdout, stale.stdout
+
+            sws('--merge-shard-results', *results, '--shard-run-id', run_id, HOST_NAME, site)
+
+            bucket = boto3.resource('s3').Bucket(HOST_NAME)
+            remote = { o.key: o.e_tag.strip('"') for o in bucket.objects.all() if o.key != '.staticwebsync' }
+            local = {}
+            for dirpath, dirnames, filenames in os.walk(site):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    with open(path, 'rb') as f:
+                        local[os.path.relpath(path, site).replace(os.sep, '/')] = hashlib.md5(f.read()).hexdigest()
+
+            assert remote == local, (remote, local)
+
+            cf = boto3.client('cloudfront')
+            distribution_id = cf.list_distributions()['DistributionList']['Items'][0]['Id']
+            invalidations = cf.list_invalidations(DistributionId=distribution_id)['InvalidationList'].get('Items', [])
+            assert len(invalidations) == 1, invalidations
+    finally:
+        server.stop()
+
+    print('sharded sync OK')
+
+if __name__ == '__main__':
+    main()
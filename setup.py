@@ -28,5 +28,5 @@ setup(
     long_description='staticwebsync is a command-line tool for automating the fiddly aspects of hosting your static web site on Amazon S3 or CloudFront. It automates the process of configuring the services for hosting web sites, and synchronizes the contents of a local folder to the site.',
 
     entry_points={'console_scripts': ['sws = staticwebsync.sws:main']},
-    install_requires=['boto3', 'termcolor', 'colorama'],
+    install_requires=['boto3>=1.28.57', 'termcolor', 'colorama'],
 )
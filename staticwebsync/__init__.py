@@ -2,6 +2,7 @@ __all__ = ('log', 'progress_callback_factory', 'progress_callback_divisions', 'B
 
 import binascii
 import hashlib
+import json
 import mimetypes
 import mmap
 import os
@@ -10,6 +11,7 @@ import re
 import time
 
 import boto3
+import boto3.s3.transfer
 import botocore
 import termcolor
 
@@ -54,6 +56,67 @@ def setup(args):
         """Use this when warning the user about something."""
         log(termcolor.colored(msg, 'red', attrs=['bold']))
 
+    # In plan mode we work out everything that a sync would do without changing
+    # anything, and write it to a file that can later be passed to --apply:
+    PLAN_FORMAT = 'staticwebsync plan'
+    PLAN_VERSION = 1
+    PLANNED_OPTIONS = ('host_name', 'folder', 'index', 'error_page', 'allow_dot_files', 'no_cloudfront', 'bucket_location', 'take_over_existing_bucket')
+
+    def is_valid_plan(p):
+        options = p.get('options')
+        if not (isinstance(options, dict) and all(option in options for option in PLANNED_OPTIONS)):
+            return False
+        if not (all(isinstance(options[option], str) for option in ('host_name', 'folder', 'index', 'bucket_location')) and
+                (options['error_page'] is None or isinstance(options['error_page'], str)) and
+                all(isinstance(options[option], bool) for option in ('allow_dot_files', 'no_cloudfront', 'take_over_existing_bucket'))):
+            return False
+        if not ((p.get('bucket') is None or isinstance(p['bucket'], str)) and
+                isinstance(p.get('uploads'), list) and
+                isinstance(p.get('deletions'), list) and
+                isinstance(p.get('invalidation_paths'), list) and all(isinstance(path, str) for path in p['invalidation_paths'])):
+            return False
+        for d in p['deletions']:
+            if not (isinstance(d, dict) and
+                    isinstance(d.get('key'), str) and
+                    isinstance(d.get('remote_e_tag'), str)):
+                return False
+        for u in p['uploads']:
+            if not (isinstance(u, dict) and
+                    isinstance(u.get('file'), str) and
+                    isinstance(u.get('key'), str) and
+                    isinstance(u.get('size'), int) and
+                    isinstance(u.get('mtime'), (int, float)) and
+                    isinstance(u.get('existed'), bool) and
+                    (u.get('remote_e_tag') is None) == (not u['existed']) and
+                    (u['remote_e_tag'] is None or isinstance(u['remote_e_tag'], str)) and
+                    isinstance(u.get('extra_args'), dict) and
+                    all(isinstance(v, str) for v in u['extra_args'].values())):
+                return False
+        return True
+
+    planning = getattr(args, 'plan', None) is not None
+    plan_filename = None
+    if planning:
+        plan_filename = os.path.abspath(args.plan)
+
+    applied_plan = None
+    if getattr(args, 'apply', None) is not None:
+        try:
+            with open(args.apply, 'r', encoding='utf-8') as f:
+                applied_plan = json.load(f)
+        except (OSError, ValueError) as e:
+            raise BadUserError("Couldn't read plan file %s: %s" % (args.apply, e))
+
+        if not isinstance(applied_plan, dict) or applied_plan.get('format') != PLAN_FORMAT:
+            raise BadUserError("%s isn't a staticwebsync plan file." % args.apply)
+        if applied_plan.get('version') != PLAN_VERSION:
+            raise BadUserError('The plan %s was made by a different version of staticwebsync. Please make a new plan.' % args.apply)
+        if not is_valid_plan(applied_plan):
+            raise BadUserError('The plan file %s is damaged.' % args.apply)
+
+        for option in PLANNED_OPTIONS:
+            setattr(args, option, applied_plan['options'][option])
+
     prefix = 'http://'
     if args.host_name.startswith(prefix):
         args.host_name = args.host_name[len(prefix):]
@@ -64,6 +127,83 @@ def setup(args):
 
     standard_bucket_name = args.host_name
 
+    # In shard mode this run only uploads the files whose keys hash to its
+    # shard, and then records what it did so that a later --merge-shard-results
+    # run can do the deletions and invalidations once for the whole site:
+    SHARD_RESULTS_FORMAT = 'staticwebsync shard results'
+    SHARD_RESULTS_VERSION = 1
+
+    shard = getattr(args, 'shard', None)
+    shard_results_filename = None
+    if shard is not None:
+        shard_results_filename = os.path.abspath(args.shard_results)
+
+    def shard_of(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % shard[1] + 1
+
+    merged_shard_results = None
+    if getattr(args, 'merge_shard_results', None):
+        merged_shard_results = []
+        for filename in args.merge_shard_results:
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    merged_shard_results.append(json.load(f))
+            except (OSError, ValueError) as e:
+                raise BadUserError("Couldn't read shard results file %s: %s" % (filename, e))
+
+        for filename, r in zip(args.merge_shard_results, merged_shard_results):
+            if not isinstance(r, dict) or r.get('format') != SHARD_RESULTS_FORMAT:
+                raise BadUserError("%s isn't a staticwebsync shard results file." % filename)
+            if r.get('version') != SHARD_RESULTS_VERSION:
+                raise BadUserError('%s was written by a different version of staticwebsync. Please run all of the shards again with this version.' % filename)
+            if not (isinstance(r.get('run_id'), str) and
+                    isinstance(r.get('host_name'), str) and
+                    isinstance(r.get('bucket'), str) and
+                    isinstance(r.get('index'), str) and
+                    isinstance(r.get('allow_dot_files'), bool) and
+                    isinstance(r.get('shard'), list) and len(r['shard']) == 2 and
+                    all(isinstance(i, int) for i in r['shard']) and
+                    isinstance(r.get('invalidations'), list) and
+                    all(isinstance(i, str) for i in r['invalidations'])):
+                raise BadUserError('The shard results file %s is damaged.' % filename)
+
+            # A leftover file from an earlier sync would otherwise be merged
+            # with its out-of-date invalidations:
+            if r['run_id'] != args.shard_run_id:
+                raise BadUserError('The shard results file %s is from the run %s, not %s.' % (filename, r['run_id'], args.shard_run_id))
+
+        shard_count = merged_shard_results[0]['shard'][1]
+        shard_indices = sorted(r['shard'][0] for r in merged_shard_results)
+        if any(r['shard'][1] != shard_count for r in merged_shard_results) or \
+            shard_indices != list(range(1, shard_count + 1)):
+            raise BadUserError('The shard results files must contain exactly one result for each shard 1/%d to %d/%d.' % (shard_count, shard_count, shard_count))
+
+        for r in merged_shard_results:
+            if r['host_name'] != args.host_name:
+                raise BadUserError('The shard results for shard %d/%d are for %s, not %s.' % (r['shard'][0], shard_count, r['host_name'], args.host_name))
+            if r['index'] != args.index or r['allow_dot_files'] != args.allow_dot_files:
+                raise BadUserError('Shard %d/%d was run with different --index or --allow-dot-files options.' % (r['shard'][0], shard_count))
+
+    dir = os.path.normpath(args.folder)
+
+    if not os.path.exists(dir):
+        raise BadUserError('Folder %s does not exist.' % args.folder)
+
+    if not os.path.isdir(dir):
+        raise BadUserError('%s is a file not a folder.' % args.folder)
+
+    if applied_plan is not None:
+        # Check that the files haven't changed since the plan was made. This
+        # only compares the sizes and modification times so that we don't have
+        # to hash everything again:
+        for u in applied_plan['uploads']:
+            try:
+                st = os.stat(os.path.join(dir, u['file']))
+            except OSError:
+                raise BadUserError('%s has been deleted since the plan was made.' % u['file'])
+            if st.st_size != u['size'] or st.st_mtime != u['mtime']:
+                raise BadUserError('%s has changed since the plan was made. Please make a new plan.' % u['file'])
+
     is_index_key = re.compile('(?P<path>^|.*?/)%s$' % re.escape(args.index))
 
     session = boto3.session.Session(
@@ -86,13 +226,58 @@ def setup(args):
     except botocore.exceptions.NoCredentialsError:
         raise BadUserError('No AWS credentials found. Please set up your ~/.aws/credentials file or specify them on the command line.')
 
-    use_cloudfront = not args.no_cloudfront
+    # Shards only upload files, so they leave the CloudFront configuration and
+    # invalidations to the run that merges their results:
+    use_cloudfront = not args.no_cloudfront and shard is None
 
     MARKER_KEY_NAME = '.staticwebsync'
+    INVALIDATION_BATCH_SIZE = 3000
+
+    if planning:
+        plan = {
+            'format': PLAN_FORMAT,
+            'version': PLAN_VERSION,
+            'options': { option: getattr(args, option) for option in PLANNED_OPTIONS },
+            'bucket': None,
+            'configuration': [],
+            'uploads': [],
+            'deletions': [],
+            'invalidation_paths': [],
+        }
+        plan['options']['folder'] = os.path.abspath(args.folder)
+        plan['options']['bucket_location'] = args.bucket_location or ''
+
+    configuration_put_requests = 0
+
+    def plan_op(msg, put_requests=0):
+        """Use this in plan mode instead of changing a setting. put_requests is the number of S3 PUT requests that making the change takes."""
+        nonlocal configuration_put_requests
+
+        log_op('would %s' % msg)
+        plan['configuration'].append(msg)
+        configuration_put_requests += put_requests
 
     def install_marker_key(bucket):
         s3.Object(bucket.name, MARKER_KEY_NAME).put(Body=b'', ACL='private')
 
+    def remote_e_tag(bucket, key):
+        o = object_or_none(bucket, key)
+        return o.e_tag if o is not None else None
+
+    def check_bucket_unchanged_since_plan(bucket):
+        """Make sure that nobody else has changed the files we're about to change, before we change anything."""
+        if applied_plan['bucket'] != bucket.name:
+            if applied_plan['bucket'] is None:
+                raise BadUserError("The plan was made before the bucket %s existed, so the bucket has changed since the plan was made. Please make a new plan." % bucket.name)
+            raise BadUserError('The plan was made for the bucket %s, but the site now uses %s. Please make a new plan.' % (applied_plan['bucket'], bucket.name))
+
+        log_check('checking that the bucket has not changed since the plan was made')
+        for key, e_tag in [(u['key'], u['remote_e_tag']) for u in applied_plan['uploads']] + \
+            [(d['key'], d['remote_e_tag']) for d in applied_plan['deletions']]:
+
+            if remote_e_tag(bucket, key) != e_tag:
+                raise BadUserError('%s in the bucket has changed since the plan was made. Please make a new plan.' % key)
+
     def object_or_none(bucket, key):
         try:
             o = s3.Object(bucket.name, key)
@@ -123,60 +308,95 @@ def setup(args):
             s3 = session.resource('s3', region_name=region)
             bucket = s3.Bucket(b.name)
 
+            if applied_plan is not None:
+                check_bucket_unchanged_since_plan(bucket)
+
             if not object_or_none(b, MARKER_KEY_NAME):
                 if not args.take_over_existing_bucket:
                     raise BadUserError("The S3 bucket %s already exists, but was not created by staticwebsync. If you wish to use it anyway and are happy for any existing files in it to be deleted if they don't have a corresponding local file then use the --take-over-existing-bucket option." % bucket.name)
 
-                install_marker_key(bucket)
+                if planning:
+                    plan_op('take over bucket %s' % bucket.name, put_requests=1)
+                else:
+                    install_marker_key(bucket)
 
             break
     else:
-        bucket_name = standard_bucket_name
-        first_fail = True
-        while True:
-            try:
-                log_op('creating bucket %s' % bucket_name)
+        if shard is not None:
+            # Letting each shard create its own bucket would race, so the
+            # first sync of a site has to be done without --shard:
+            raise BadUserError("The S3 bucket for %s doesn't exist yet. Please do an initial sync without --shard to create it." % args.host_name)
 
-                configuration = None
+        if merged_shard_results is not None:
+            raise BadUserError("The S3 bucket for %s doesn't exist, so the shard results can't be for it." % args.host_name)
 
-                region = args.bucket_location
-                if not region or region == 'US': region = 'us-east-1'
+        if applied_plan is not None and applied_plan['bucket'] is not None:
+            raise BadUserError("The plan was made for the bucket %s, but it doesn't exist any more. Please make a new plan." % applied_plan['bucket'])
 
-                if region != 'us-east-1':
-                    configuration = { 'LocationConstraint': region }
+        bucket_name = standard_bucket_name
+        first_fail = True
+        if planning:
+            # This is the first sync of the site, so every file will be a new
+            # upload. Creating the bucket and installing the marker key are both
+            # PUT requests:
+            plan_op('create bucket %s' % bucket_name, put_requests=2)
+
+            region = args.bucket_location
+            if not region or region == 'US': region = 'us-east-1'
+        else:
+            while True:
+                try:
+                    log_op('creating bucket %s' % bucket_name)
 
-                s3 = session.resource('s3', region_name=region)
-                if configuration:
-                    bucket = s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration=configuration)
-                else:
-                    bucket = s3.create_bucket(Bucket=bucket_name)
+                    configuration = None
 
-                install_marker_key(bucket)
-                break
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == 'BucketAlreadyExists':
-                    log_warn('bucket %s was already used by another user' % bucket_name)
-                    if first_fail:
-                        log_warn('We can use an alternative bucket name, but this will only work with CloudFront and not with standard S3 web site hosting (because it requires the bucket name to match the host name).')
-                        first_fail = False
-                    if not use_cloudfront:
-                        raise BadUserError("Using CloudFront is disabled, so we can't continue.")
-                    bucket_name = standard_bucket_name + '-' + binascii.b2a_hex(os.urandom(8)).decode('ascii')
-                    continue
-                else:
-                    raise e
+                    region = args.bucket_location
+                    if not region or region == 'US': region = 'us-east-1'
 
-    log_op('configuring bucket ACL policy')
-    bucket.Acl().put(ACL='private')
+                    if region != 'us-east-1':
+                        configuration = { 'LocationConstraint': region }
 
-    log_op('configuring bucket for website access')
-    website_configuration = { 'IndexDocument': { 'Suffix': args.index } }
-    if args.error_page is not None:
-        website_configuration['ErrorDocument'] = { 'Key': args.error_page }
-    bucket.Website().put(WebsiteConfiguration=website_configuration)
+                    s3 = session.resource('s3', region_name=region)
+                    if configuration:
+                        bucket = s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration=configuration)
+                    else:
+                        bucket = s3.create_bucket(Bucket=bucket_name)
+
+                    install_marker_key(bucket)
+                    break
+                except botocore.exceptions.ClientError as e:
+                    if e.response['Error']['Code'] == 'BucketAlreadyExists':
+                        log_warn('bucket %s was already used by another user' % bucket_name)
+                        if first_fail:
+                            log_warn('We can use an alternative bucket name, but this will only work with CloudFront and not with standard S3 web site hosting (because it requires the bucket name to match the host name).')
+                            first_fail = False
+                        if not use_cloudfront:
+                            raise BadUserError("Using CloudFront is disabled, so we can't continue.")
+                        bucket_name = standard_bucket_name + '-' + binascii.b2a_hex(os.urandom(8)).decode('ascii')
+                        continue
+                    else:
+                        raise e
+
+    if merged_shard_results is not None:
+        for r in merged_shard_results:
+            if r['bucket'] != bucket.name:
+                raise BadUserError('The shard results for shard %d/%d were for the bucket %s, not %s.' % (r['shard'][0], r['shard'][1], r['bucket'], bucket.name))
+
+    if planning:
+        plan['bucket'] = bucket.name if bucket is not None else None
+        plan_op('configure bucket ACL policy and website access', put_requests=2)
+    elif shard is None:
+        log_op('configuring bucket ACL policy')
+        bucket.Acl().put(ACL='private')
+
+        log_op('configuring bucket for website access')
+        website_configuration = { 'IndexDocument': { 'Suffix': args.index } }
+        if args.error_page is not None:
+            website_configuration['ErrorDocument'] = { 'Key': args.error_page }
+        bucket.Website().put(WebsiteConfiguration=website_configuration)
 
     # http://docs.aws.amazon.com/AmazonS3/latest/dev/WebsiteEndpoints.html
-    website_endpoint = '%s.s3-website-%s.amazonaws.com' % (bucket.name, region)
+    website_endpoint = '%s.s3-website-%s.amazonaws.com' % (bucket.name if bucket is not None else bucket_name, region)
 
     def set_caller_reference(options):
         options['CallerReference'] = binascii.b2a_hex(os.urandom(8)).decode('ascii')
@@ -276,28 +496,32 @@ def setup(args):
                 # TODO Remove the alias if a force option is given.
                 raise BadUserError("Existing distribution %s has this hostname set as an alternate domain name (CNAME), but it isn't associated with the correct origin bucket. Please remove the alternate domain name from the distribution or delete the distribution." % distribution_summary['Id'])
         else:
-            log_op('creating CloudFront distribution')
-
-            creation_config = {}
-            set_required_config(creation_config)
-
-            # Set defaults for options that are required to create a distribution:
-            creation_config.setdefault('Comment', '')
-            default_cache_behavior = creation_config.setdefault('DefaultCacheBehavior', {})
-            trusted_signers = default_cache_behavior.setdefault('TrustedSigners', {})
-            trusted_signers.setdefault('Enabled', False)
-            trusted_signers.setdefault('Quantity', 0)
-            default_cache_behavior.setdefault('ViewerProtocolPolicy', 'allow-all')
-            default_cache_behavior.setdefault('MinTTL', 0)
-
-            set_caller_reference(creation_config)
-
-            distribution_creation_response = cf.create_distribution(DistributionConfig=creation_config)
-            distribution_id = distribution_creation_response['Distribution']['Id']
-            distribution_domain_name = distribution_creation_response['Distribution']['DomainName']
-            log_op('created distribution %s' % distribution_id)
             created_new_distribution = True
 
+            if planning:
+                plan_op('create CloudFront distribution')
+            else:
+                log_op('creating CloudFront distribution')
+
+                creation_config = {}
+                set_required_config(creation_config)
+
+                # Set defaults for options that are required to create a distribution:
+                creation_config.setdefault('Comment', '')
+                default_cache_behavior = creation_config.setdefault('DefaultCacheBehavior', {})
+                trusted_signers = default_cache_behavior.setdefault('TrustedSigners', {})
+                trusted_signers.setdefault('Enabled', False)
+                trusted_signers.setdefault('Quantity', 0)
+                default_cache_behavior.setdefault('ViewerProtocolPolicy', 'allow-all')
+                default_cache_behavior.setdefault('MinTTL', 0)
+
+                set_caller_reference(creation_config)
+
+                distribution_creation_response = cf.create_distribution(DistributionConfig=creation_config)
+                distribution_id = distribution_creation_response['Distribution']['Id']
+                distribution_domain_name = distribution_creation_response['Distribution']['DomainName']
+                log_op('created distribution %s' % distribution_id)
+
         if not created_new_distribution:
             log_check('checking distribution configuration')
 
@@ -305,12 +529,15 @@ def setup(args):
             update_config = get_distribution_config_response['DistributionConfig']
 
             if set_required_config(update_config):
-                log_op('configuring distribution')
+                if planning:
+                    plan_op('configure distribution')
+                else:
+                    log_op('configuring distribution')
 
-                cf.update_distribution(
-                    Id=distribution_id,
-                    IfMatch=get_distribution_config_response['ETag'],
-                    DistributionConfig=update_config)
+                    cf.update_distribution(
+                        Id=distribution_id,
+                        IfMatch=get_distribution_config_response['ETag'],
+                        DistributionConfig=update_config)
             else:
                 log_noop('distribution configuration already fine')
 
@@ -325,152 +552,300 @@ def setup(args):
     # TODO Serialize these in case of failure, and resume when restarting:
     invalidations = []
 
-    dir = os.path.normpath(args.folder)
+    os.chdir(dir)
 
-    if not os.path.exists(dir):
-        raise BadUserError('Folder %s does not exist.' % args.folder)
+    # Convert our callbacks to be compatible with the boto3 upload callback API:
+    class CallbackWrapper:
+        def __init__(self, old_callback_factory, file_size):
+            self.old_callback = old_callback_factory()
+            self.file_size = file_size
+            self.total_transferred = 0
+        def __call__(self, newly_transferred_bytes_count):
+            self.total_transferred += newly_transferred_bytes_count
+            # The default factory doesn't make a callback (e.g. when the output isn't a terminal):
+            if self.old_callback is not None:
+                self.old_callback(self.total_transferred, self.file_size)
+
+    def upload_invalidations(u):
+        if not u['existed']:
+            return []
+
+        keys = [u['key']]
+
+        # Index pages are likely to be cached in CloudFront without the trailing filename instead (or as well).
+        m = is_index_key.match(u['key'])
+        if m:
+            keys.append(m.group('path'))
+
+        return keys
+
+    def delete_invalidations(key):
+        return [key]
+
+    def perform_upload(u):
+        log_op('uploading %s' % u['key'])
+
+        upload_extra_args = dict(u['extra_args'])
+        upload_extra_args['ACL'] = 'public-read'
+
+        obj = s3.Object(bucket.name, u['key'])
+        obj.upload_file(u['file'], ExtraArgs=upload_extra_args,
+            Callback=CallbackWrapper(progress_callback_factory, u['size']))
+
+        invalidations.extend(upload_invalidations(u))
+
+    def perform_delete(key):
+        log_op('deleting %s' % key)
+        s3.Object(bucket.name, key).delete()
+        invalidations.extend(delete_invalidations(key))
+
+    if merged_shard_results is not None:
+        # The shards have already uploaded everything, so we just need their
+        # invalidations:
+        for r in merged_shard_results:
+            invalidations.extend(r['invalidations'])
+    elif applied_plan is not None:
+        for u in applied_plan['uploads']:
+            perform_upload(u)
+    else:
+        for (dirpath, dirnames, filenames) in os.walk('.'):
+            if not args.allow_dot_files:
+                blacklisted = False
+                for p in split_all(dirpath, os.path.split):
+                    if p.startswith('.') and p != '.':
+                        log_noop('skipping folder %s' % os.path.normpath(dirpath))
+                        blacklisted = True
+                        break
+                if blacklisted:
+                    continue
 
-    if not os.path.isdir(dir):
-        raise BadUserError('%s is a file not a folder.' % args.folder)
+            for filename in filenames:
+                if not args.allow_dot_files and filename.startswith('.'):
+                    log_noop('skipping file %s' % filename)
+                    continue
 
-    os.chdir(dir)
+                inf = os.path.normpath(os.path.join(dirpath, filename))
 
-    for (dirpath, dirnames, filenames) in os.walk('.'):
-        if not args.allow_dot_files:
-            blacklisted = False
-            for p in split_all(dirpath, os.path.split):
-                if p.startswith('.') and p != '.':
-                    log_noop('skipping folder %s' % os.path.normpath(dirpath))
-                    blacklisted = True
-                    break
-            if blacklisted:
-                continue
+                d = os.path.normpath(dirpath)
+                if d == '.':
+                    d = ''
 
-        for filename in filenames:
-            if not args.allow_dot_files and filename.startswith('.'):
-                log_noop('skipping file %s' % filename)
-                continue
+                type = mimetypes.guess_type(filename, strict=False)
+                upload_extra_args = {}
+                if type[0] is not None:
+                    # the lack of hyphens in the keys is correct, because these are method arguments rather than HTTP headers:
+                    upload_extra_args['ContentType'] = type[0]
+                if type[1] is not None:
+                    upload_extra_args['ContentEncoding'] = type[1]
 
-            inf = os.path.normpath(os.path.join(dirpath, filename))
+                def upload(f):
+                    # We could re-use this when uploading the same file twice, but
+                    # the code would be a bit messy.
+                    md5 = None
 
-            d = os.path.normpath(dirpath)
-            if d == '.':
-                d = ''
+                    parts = list(split_all(d, os.path.split))
+                    parts.append(f)
+                    outf = posixpath.join(*parts)
+                    if outf == '':
+                        outf = args.index
 
-            type = mimetypes.guess_type(filename, strict=False)
-            upload_extra_args = {}
-            if type[0] is not None:
-                # the lack of hyphens in the keys is correct, because these are method arguments rather than HTTP headers:
-                upload_extra_args['ContentType'] = type[0]
-            if type[1] is not None:
-                upload_extra_args['ContentEncoding'] = type[1]
+                    if shard is not None and shard_of(outf) != shard[0]:
+                        return
 
-            def upload(f):
-                # We could re-use this when uploading the same file twice, but
-                # the code would be a bit messy.
-                md5 = None
+                    log_check('processing "%s" -> "%s"' % (inf, outf))
 
-                parts = list(split_all(d, os.path.split))
-                parts.append(f)
-                outf = posixpath.join(*parts)
-                if outf == '':
-                    outf = args.index
+                    existed = False
+                    remote_e_tag = None
+                    reason = 'new'
+
+                    # There's no bucket yet when planning the first sync of a site:
+                    if bucket is not None:
+                        obj = s3.Object(bucket.name, outf)
+
+                        try:
+                            obj.load()
+                            existed = True
+                            remote_e_tag = obj.e_tag
+
+                            log_noop('%s exists in bucket' % outf)
+                            md5 = md5_hex_digest_string(inf)
+                            if obj.e_tag != '"%s"' % md5:
+                                reason = 'content'
+                            elif obj.content_type == upload_extra_args.get('ContentType', obj.content_type) and \
+                                obj.content_encoding == upload_extra_args.get('ContentEncoding'):
+
+                                # TODO Check for other headers?
+                                log_noop('%s matches local file' % outf)
+                                if not args.repair:
+                                    return
+
+                                acl = obj.Acl()
+                                user_grant_okay = False
+                                public_grant_okay = False
+                                for grant in acl.grants:
+                                    grantee = grant['Grantee']
+                                    if grantee.get('ID') == acl.owner['ID']:
+                                        user_grant_okay = grant['Permission'] == 'FULL_CONTROL'
+                                        if not user_grant_okay:
+                                            break
+                                    elif grantee['Type'] == 'Group':
+                                        public_grant_okay = \
+                                            grantee['URI'] == 'http://acs.amazonaws.com/groups/global/AllUsers' and \
+                                            grant['Permission'] == 'READ'
+                                        if not public_grant_okay:
+                                            break
+                                    else:
+                                        break
+                                else:
+                                    if user_grant_okay and public_grant_okay:
+                                        log_noop('%s ACL is fine' % outf)
+                                        return
+                                log_op('%s ACL is wrong' % outf)
+                                reason = 'acl'
+                            else:
+                                reason = 'headers'
+
+                        except botocore.exceptions.ClientError as ce:
+                            if ce.response['Error']['Code'] != '404':
+                                raise ce
+
+                    st = os.stat(inf)
+                    u = {
+                        'file': inf,
+                        'key': outf,
+                        'size': st.st_size,
+                        'mtime': st.st_mtime,
+                        'extra_args': upload_extra_args,
+                        'existed': existed,
+                        'remote_e_tag': remote_e_tag,
+                        'reason': reason,
+                    }
+
+                    if planning:
+                        log_op('would upload %s (%s)' % (outf, reason))
+                        plan['uploads'].append(u)
+                    else:
+                        perform_upload(u)
+
+                upload(filename)
+
+    if shard is not None:
+        log_op('writing results for shard %d/%d' % shard)
+        with open(shard_results_filename, 'w', encoding='utf-8') as f:
+            json.dump({
+                'format': SHARD_RESULTS_FORMAT,
+                'version': SHARD_RESULTS_VERSION,
+                'run_id': args.shard_run_id,
+                'host_name': args.host_name,
+                'bucket': bucket.name,
+                'index': args.index,
+                'allow_dot_files': args.allow_dot_files,
+                'shard': shard,
+                'invalidations': invalidations,
+            }, f)
+        log_op('shard %d/%d complete' % shard)
+        return
 
-                log_check('processing "%s" -> "%s"' % (inf, outf))
+    if applied_plan is not None:
+        for d in applied_plan['deletions']:
+            perform_delete(d['key'])
+    elif bucket is not None:
+        log_check('checking for deleted files')
 
-                obj = s3.Object(bucket.name, outf)
+        for obj in list(bucket.objects.all()):
+            name = obj.key
+            if name == MARKER_KEY_NAME:
+                continue
+            if name.endswith('/'):
+                name = posixpath.join(name, args.index)
+            parts = split_all(name, posixpath.split)
+            blacklisted = False
+            if not args.allow_dot_files:
+                for p in parts:
+                    if p.startswith('.'):
+                        blacklisted = True
+                        break
+            if not blacklisted and os.path.isfile(os.path.join(*parts)):
+                log_noop('%s has corresponding local file' % obj.key)
+                continue
+            if planning:
+                log_op('would delete %s' % obj.key)
+                plan['deletions'].append({ 'key': obj.key, 'remote_e_tag': obj.e_tag })
+            else:
+                perform_delete(obj.key)
 
-                try:
-                    obj.load()
-                    existed = True
-
-                    log_noop('%s exists in bucket' % outf)
-                    md5 = md5_hex_digest_string(inf)
-                    if obj.e_tag == '"%s"' % md5 and \
-                        obj.content_type == upload_extra_args.get('ContentType', obj.content_type) and \
-                        obj.content_encoding == upload_extra_args.get('ContentEncoding'):
-
-                        # TODO Check for other headers?
-                        log_noop('%s matches local file' % outf)
-                        if not args.repair:
-                            return
-
-                        acl = obj.Acl()
-                        user_grant_okay = False
-                        public_grant_okay = False
-                        for grant in acl.grants:
-                            grantee = grant['Grantee']
-                            if grantee.get('ID') == acl.owner['ID']:
-                                user_grant_okay = grant['Permission'] == 'FULL_CONTROL'
-                                if not user_grant_okay:
-                                    break
-                            elif grantee['Type'] == 'Group':
-                                public_grant_okay = \
-                                    grantee['URI'] == 'http://acs.amazonaws.com/groups/global/AllUsers' and \
-                                    grant['Permission'] == 'READ'
-                                if not public_grant_okay:
-                                    break
-                            else:
-                                break
-                        else:
-                            if user_grant_okay and public_grant_okay:
-                                log_noop('%s ACL is fine' % outf)
-                                return
-                        log_op('%s ACL is wrong' % outf)
-
-                except botocore.exceptions.ClientError as ce:
-                    if ce.response['Error']['Code'] != '404':
-                        raise ce
-                    existed = False
+    def invalidation_paths(invalidations):
+        paths = []
+        seen_paths = set()
 
-                log_op('uploading %s' % outf)
-                upload_extra_args['ACL'] = 'public-read'
-
-                # Convert our callbacks to be compatible with the boto3 upload callback API:
-                class CallbackWrapper:
-                    def __init__(self, old_callback_factory, file_size):
-                        self.old_callback = old_callback_factory()
-                        self.file_size = file_size
-                        self.total_transferred = 0
-                    def __call__(self, newly_transferred_bytes_count):
-                        self.total_transferred += newly_transferred_bytes_count
-                        self.old_callback(self.total_transferred, self.file_size)
-
-                obj.upload_file(inf, ExtraArgs=upload_extra_args,
-                    Callback=CallbackWrapper(progress_callback_factory, os.path.getsize(inf)))
-
-                if existed:
-                    key_name = obj.key
-                    invalidations.append(key_name)
-
-                    # Index pages are likely to be cached in CloudFront without the trailing filename instead (or as well).
-                    m = is_index_key.match(key_name)
-                    if m:
-                        invalidations.append(m.group('path'))
-
-            upload(filename)
-
-    log_check('checking for deleted files')
-
-    for obj in list(bucket.objects.all()):
-        name = obj.key
-        if name == MARKER_KEY_NAME:
-            continue
-        if name.endswith('/'):
-            name = posixpath.join(name, args.index)
-        parts = split_all(name, posixpath.split)
-        blacklisted = False
-        if not args.allow_dot_files:
-            for p in parts:
-                if p.startswith('.'):
-                    blacklisted = True
-                    break
-        if not blacklisted and os.path.isfile(os.path.join(*parts)):
-            log_noop('%s has corresponding local file' % obj.key)
-            continue
-        log_op('deleting %s' % obj.key)
-        obj.delete()
-        invalidations.append(obj.key)
+        def add(path):
+            # Merged shard results can mention the same path more than once:
+            if path in seen_paths:
+                return
+            seen_paths.add(path)
+            paths.append(path)
+
+        for i in invalidations:
+            add('/' + i)
+            if (i == args.index):
+                add('/')
+
+        return paths
+
+    if planning:
+        for u in plan['uploads']:
+            invalidations.extend(upload_invalidations(u))
+        for d in plan['deletions']:
+            invalidations.extend(delete_invalidations(d['key']))
+
+        if use_cloudfront:
+            plan['invalidation_paths'] = invalidation_paths(invalidations)
+
+        # These mirror the defaults that upload_file uses, so that we can count
+        # the requests that a multipart upload will make:
+        transfer_config = boto3.s3.transfer.TransferConfig()
+
+        # US East (N. Virginia) list prices in USD:
+        S3_PUT_REQUEST_PRICE = 0.005 / 1000
+        CLOUDFRONT_INVALIDATION_PATH_PRICE = 0.005
+        CLOUDFRONT_FREE_INVALIDATION_PATHS_PER_MONTH = 1000
+
+        upload_bytes = 0
+        upload_put_requests = 0
+        for u in plan['uploads']:
+            upload_bytes += u['size']
+            if u['size'] < transfer_config.multipart_threshold:
+                upload_put_requests += 1
+            else:
+                # The initiating and completing requests plus one per part:
+                upload_put_requests += 2 + -(-u['size'] // transfer_config.multipart_chunksize)
+        put_requests = configuration_put_requests + upload_put_requests
+
+        invalidation_path_count = len(plan['invalidation_paths'])
+        plan['estimates'] = {
+            'upload_bytes': upload_bytes,
+            'put_requests': put_requests,
+            'upload_put_requests': upload_put_requests,
+            'delete_requests': len(plan['deletions']),
+            'invalidation_paths': invalidation_path_count,
+            'invalidation_batches': -(-invalidation_path_count // INVALIDATION_BATCH_SIZE),
+            's3_request_cost': put_requests * S3_PUT_REQUEST_PRICE,
+            'cloudfront_invalidation_cost': invalidation_path_count * CLOUDFRONT_INVALIDATION_PATH_PRICE,
+        }
+
+        estimates = plan['estimates']
+        log_check('plan: %d uploads (%d bytes), %d deletions, %d invalidation paths' % (
+            len(plan['uploads']), upload_bytes, len(plan['deletions']), invalidation_path_count))
+        log_check('estimated requests: %d S3 PUT/POST (%d for uploads), %d S3 DELETE, %d CloudFront invalidation batches' % (
+            put_requests, upload_put_requests, estimates['delete_requests'], estimates['invalidation_batches']))
+        log_check('estimated cost at US East list prices: $%.4f for S3 requests, up to $%.2f for CloudFront invalidations (the first %d invalidation paths each month are free)' % (
+            estimates['s3_request_cost'], estimates['cloudfront_invalidation_cost'], CLOUDFRONT_FREE_INVALIDATION_PATHS_PER_MONTH))
+
+        with open(plan_filename, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, indent=1)
+        log_op('plan written to %s' % plan_filename)
+        log_noop('the bucket and distribution configuration will be checked again when the plan is applied, and only changed if it still needs to be; the uploads, deletions and invalidations will be carried out exactly as planned')
+        return
 
     def log_sync_complete(dns_entry_name, dns_entry_target):
         log_op('sync complete')
@@ -501,7 +876,12 @@ def setup(args):
             log_check('propagation still in progress; checking again in %d seconds' % interval)
             time.sleep(interval)
 
-    if len(invalidations) == 0:
+    if applied_plan is not None:
+        paths = applied_plan['invalidation_paths']
+    else:
+        paths = invalidation_paths(invalidations)
+
+    if len(paths) == 0:
         cf_complete()
         return
 
@@ -528,21 +908,7 @@ def setup(args):
                 log_check('too many invalidations in progress; trying again in %d seconds' % interval)
                 time.sleep(interval)
 
-        paths.clear()
-
-    paths = []
-
-    def invalidate(path):
-        paths.append(path)
-        if len(paths) == 3000:
-            invalidate_all(paths)
-
-    for i in invalidations:
-        invalidate('/' + i)
-        if (i == args.index):
-            invalidate('/')
-
-    if len(paths) > 0:
-        invalidate_all(paths)
+    for i in range(0, len(paths), INVALIDATION_BATCH_SIZE):
+        invalidate_all(paths[i:i + INVALIDATION_BATCH_SIZE])
 
     cf_complete()
@@ -30,6 +30,15 @@ class progress_reporter:
         if done == doing:
             print('\r' + (' ' * 80), end='\r')
 
+def shard_spec(s):
+    try:
+        index, count = (int(part) for part in s.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r isn't of the form I/N" % s)
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('%r must have 1 <= I <= N' % s)
+    return (index, count)
+
 def main():
     colorama.init()
 
@@ -39,6 +48,18 @@ def main():
 
     DEFAULT_LOCATION = 'us-east-1'
 
+    # These options are taken from the plan when using --apply, so they default
+    # to None to tell whether they were given, and the real defaults are filled
+    # in afterwards:
+    PLANNED_OPTION_DEFAULTS = {
+        'index': 'index.html',
+        'error_page': '4xx.html',
+        'allow_dot_files': False,
+        'bucket_location': DEFAULT_LOCATION,
+        'no_cloudfront': False,
+        'take_over_existing_bucket': False,
+    }
+
     if len(sys.argv) == 1:
         sys.argv.append('-h')
 
@@ -54,16 +75,16 @@ def main():
     arg_parser.add_argument('--secret-access-key', default=None,
         help=help_text_with_default("Your Amazon Web Services secret access key", "read from your ~/.aws/credentials file or the AWS_SECRET_ACCESS_KEY environment variable if they exist"))
 
-    arg_parser.add_argument('--index', default='index.html',
-        help=help_text_with_default("The name of the default file that should be used for the root of the web-site and for requests that correspond to folder names without a filename"))
+    arg_parser.add_argument('--index', default=None,
+        help=help_text_with_default("The name of the default file that should be used for the root of the web-site and for requests that correspond to folder names without a filename", PLANNED_OPTION_DEFAULTS['index']))
 
-    arg_parser.add_argument('--error-page', default='4xx.html',
-        help=help_text_with_default("The name of a file that should be sent for missing files (404 errors) or any other HTTP errors with 4xx codes"))
+    arg_parser.add_argument('--error-page', default=None,
+        help=help_text_with_default("The name of a file that should be sent for missing files (404 errors) or any other HTTP errors with 4xx codes", PLANNED_OPTION_DEFAULTS['error_page']))
 
     arg_parser.add_argument('--repair', action='store_true',
         help="Do extra checks that take additional time and that shouldn't be needed under normal circumstances. This option might be helpful if things aren't working right or if you have used another tool to manage the bucket in the past. Currently it checks that the security policy (ACL) for every existing file is correct.")
 
-    arg_parser.add_argument('--allow-dot-files', action='store_true',
+    arg_parser.add_argument('--allow-dot-files', action='store_true', default=None,
         help="Normally %(prog)s skips files and folders that start with a '.' because those are often used by tools like version control systems for internal data. Use this option to force such files to be uploaded to the web site.")
 
     arg_parser.add_argument('--bucket-location', choices = (
@@ -78,26 +99,71 @@ def main():
         'ap-northeast-1',
         'ap-northeast-2',
         'sa-east-1'),
-        default=DEFAULT_LOCATION,
-        help=help_text_with_default("The location that will be used for any new S3 buckets created. This doesn't have any effect if the bucket for the web site already exists, but in a future version this might give an error if it doesn't match the location of the existing bucket."))
+        default=None,
+        help=help_text_with_default("The location that will be used for any new S3 buckets created. This doesn't have any effect if the bucket for the web site already exists, but in a future version this might give an error if it doesn't match the location of the existing bucket.", DEFAULT_LOCATION))
 
-    arg_parser.add_argument('--no-cloudfront', action='store_true',
+    arg_parser.add_argument('--no-cloudfront', action='store_true', default=None,
         help="Use this option if you just want your site hosted on S3 and do not want to use CloudFront as well. See the %(prog)s web site for advice about why you might want to do that.")
 
     arg_parser.add_argument('--dont-wait-for-cloudfront-propagation', action='store_true',
         help="When you change or delete files hosted on CloudFront it takes up to 15 minutes to propagate that change across all CloudFront servers. Normally %(prog)s waits for that to finish before completing so that you know that when it is complete your site is up-to-date, but if you use this option then the program will not wait and just return immediately after it has finished syncing your files.")
 
-    arg_parser.add_argument('--take-over-existing-bucket', action='store_true',
+    arg_parser.add_argument('--take-over-existing-bucket', action='store_true', default=None,
         help="%(prog)s uses an S3 bucket with the same name as the host name for the site. If it finds such a bucket that it didn't create itself then it will normally refuse to sync. This is a safety precaution: %(prog)s does one-way syncing of files, so it deletes anything in the bucket that doesn't have a corresponding local file. If the bucket existed already then there might be files in it that you care about, so %(prog)s plays it safe and refuses to use such a bucket. If you use this option then %(prog)s will treat the bucket as if it created it, and will put a marker key in the bucket to signify that so this option only needs to be used on the first sync.")
 
-    arg_parser.add_argument('host_name',
+    arg_parser.add_argument('--shard', type=shard_spec, default=None, metavar='I/N',
+        help="Split the sync between N separate runs of %(prog)s (for example on different CI nodes), of which this is run number I (counting from 1). Each run only uploads the files whose names hash to its shard, and then writes its results to the file given by --shard-results instead of deleting files or invalidating CloudFront caches. When all of the shards have finished, run %(prog)s once more with --merge-shard-results to complete the sync. The site must have been synced at least once without this option first so that the S3 bucket exists.")
+
+    arg_parser.add_argument('--shard-results', default=None, metavar='FILE',
+        help="The file that a --shard run should write its results to.")
+
+    arg_parser.add_argument('--shard-run-id', default=None, metavar='ID',
+        help="An identifier for this sync, such as a CI pipeline ID, that must be the same for every --shard run and for the --merge-shard-results run that completes it. It is used to make sure that results left over from an earlier sync are never merged.")
+
+    arg_parser.add_argument('--merge-shard-results', nargs='+', default=None, metavar='FILE',
+        help="Complete a sync that was split using --shard, by reading the results files written by every shard, deleting files in the bucket that don't have a corresponding local file, and sending one combined set of CloudFront cache invalidations. No files are uploaded by this run.")
+
+    arg_parser.add_argument('--plan', default=None, metavar='FILE',
+        help="Work out everything that a sync would do (the files that would be uploaded or deleted, the CloudFront cache invalidations that would be sent and any configuration changes) without changing anything, report an estimate of the number of requests and their cost, and write the plan to FILE so that it can be reviewed and then carried out with --apply.")
+
+    arg_parser.add_argument('--apply', default=None, metavar='FILE',
+        help="Carry out a plan that was written by --plan, without checking the local files for changes again other than making sure that their sizes and modification times haven't changed since. Nothing is changed if any of the files in the plan have changed locally or in the bucket since the plan was made. The host name, folder and other options that affect what is synced are taken from the plan, so they can't be given. The bucket and distribution configuration is checked again and only changed if it still needs to be.")
+
+    arg_parser.add_argument('host_name', nargs='?',
         help="The host name for the site")
 
-    arg_parser.add_argument('folder',
+    arg_parser.add_argument('folder', nargs='?',
         help="The folder containing the files to be uploaded to the web site")
 
     args = arg_parser.parse_args()
 
+    if args.shard is not None and args.shard_results is None:
+        arg_parser.error('--shard requires --shard-results')
+    if args.shard is None and args.shard_results is not None:
+        arg_parser.error('--shard-results can only be used with --shard')
+    if args.shard is not None and args.merge_shard_results is not None:
+        arg_parser.error("--shard and --merge-shard-results can't be used together")
+    if (args.shard is not None or args.merge_shard_results is not None) and args.shard_run_id is None:
+        arg_parser.error('--shard and --merge-shard-results require --shard-run-id')
+    if args.shard is None and args.merge_shard_results is None and args.shard_run_id is not None:
+        arg_parser.error('--shard-run-id can only be used with --shard or --merge-shard-results')
+    if (args.plan is not None or args.apply is not None) and (args.shard is not None or args.merge_shard_results is not None):
+        arg_parser.error("--plan and --apply can't be used with --shard or --merge-shard-results")
+    if args.plan is not None and args.apply is not None:
+        arg_parser.error("--plan and --apply can't be used together")
+    if args.apply is not None:
+        if args.host_name is not None or args.folder is not None:
+            arg_parser.error('the host name and folder are taken from the plan when using --apply')
+        for option in PLANNED_OPTION_DEFAULTS:
+            if getattr(args, option) is not None:
+                arg_parser.error('--%s is taken from the plan when using --apply' % option.replace('_', '-'))
+    elif args.host_name is None or args.folder is None:
+        arg_parser.error('the following arguments are required: host_name, folder')
+
+    for option, default in PLANNED_OPTION_DEFAULTS.items():
+        if getattr(args, option) is None:
+            setattr(args, option, default)
+
     if args.bucket_location == DEFAULT_LOCATION:
         args.bucket_location = ''
 